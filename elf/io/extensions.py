@@ -34,11 +34,10 @@ def _ensure_iterable(item):
 
 
 def register_filetype(constructor, extensions=(), groups=(), datasets=()):
-    extensions = _ensure_iterable(extensions)
+    # extensions are stored lower case, extensions that are registered already are not overridden
+    extensions = [ext.lower() for ext in _ensure_iterable(extensions)]
     FILE_CONSTRUCTORS.update({
-        ext.lower(): constructor
-        for ext in _ensure_iterable(extensions)
-        if ext not in FILE_CONSTRUCTORS
+        ext: constructor for ext in extensions if ext not in FILE_CONSTRUCTORS
     })
     GROUP_LIKE.extend(_ensure_iterable(groups))
     DATASET_LIKE.extend(_ensure_iterable(datasets))
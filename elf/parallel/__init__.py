@@ -1,7 +1,7 @@
 from .copy_dataset import copy_dataset
 from .operations import (apply_operation, add, divide, multiply, subtract,
                          greater, greater_equal, less, less_equal,
-                         minimum, maximum, isin)
+                         minimum, maximum, isin, compute_mask_occupancy, Expr)
 from .relabel import relabel_consecutive
 from .stats import mean, std, mean_and_std, max, min, min_and_max
 from .unique import unique
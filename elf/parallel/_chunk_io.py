@@ -0,0 +1,164 @@
+# read and write blocks that correspond to a single chunk of a hdf5 dataset with direct chunk access,
+# which bypasses the selection and type conversion machinery of h5py.
+# all hdf5 calls are serialized by the global lock of h5py, but with direct chunk access
+# the (de)compression of the chunks happens outside of it, so it runs in parallel in the worker threads
+import zlib
+from concurrent import futures
+try:
+    import h5py
+except ImportError:
+    h5py = None
+import numpy as np
+
+
+def _get_direct_chunk_filters(data, bbs, full_chunks=False):
+    # returns the filter pipeline of the dataset as list of (filter_code, filter_values)
+    # or None if we can't use direct chunk access
+    # for writing, the blocks must cover their whole chunk (clipped to the dataset), because
+    # direct chunk writes replace the chunk and would overwrite the data outside of the block
+    if h5py is None or not isinstance(data, h5py.Dataset) or data.chunks is None:
+        return None
+    # reading into an existing buffer needs h5py >= 3.8
+    if h5py.version.version_tuple < (3, 8):
+        return None
+    chunks, shape = data.chunks, data.shape
+    if full_chunks:
+        aligned = all(b.start % ch == 0 and b.stop == min(b.start + ch, sh)
+                      for bb in bbs for b, ch, sh in zip(bb, chunks, shape))
+    else:
+        aligned = all(b.start % ch == 0 and b.stop - b.start <= ch for bb in bbs for b, ch in zip(bb, chunks))
+    if not aligned:
+        return None
+    # direct chunk access returns the stored bytes, so we need to apply the filters ourselves,
+    # which we only do for gzip compression and shuffle
+    plist = data.id.get_create_plist()
+    filters = []
+    for filter_id in range(plist.get_nfilters()):
+        code, _, values, _ = plist.get_filter(filter_id)
+        filters.append((code, values))
+    if any(code not in (h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE) for code, _ in filters):
+        return None
+    return filters
+
+
+def _decode_chunk(raw, filters, filter_mask, dtype):
+    # undo the filters in reverse order, filters that were skipped for this chunk are set in the filter mask
+    for filter_id in range(len(filters) - 1, -1, -1):
+        if filter_mask & (1 << filter_id):
+            continue
+        if filters[filter_id][0] == h5py.h5z.FILTER_DEFLATE:
+            raw = zlib.decompress(raw)
+        else:
+            raw = np.frombuffer(raw, dtype="uint8").reshape(dtype.itemsize, -1).T.tobytes()
+    # copy to a bytearray, so that the block is writeable
+    return np.frombuffer(bytearray(raw), dtype=dtype)
+
+
+def _encode_chunk(chunk, filters):
+    raw = chunk.tobytes()
+    for code, values in filters:
+        if code == h5py.h5z.FILTER_DEFLATE:
+            raw = zlib.compress(raw, values[0])
+        else:
+            raw = np.frombuffer(raw, dtype="uint8").reshape(-1, chunk.dtype.itemsize).T.tobytes()
+    return raw
+
+
+def get_block_reader(data, bbs):
+    """ Get function to read the blocks with the given bounding boxes from the data.
+
+    Uses direct chunk reads for hdf5 datasets that are uncompressed or gzip compressed
+    if the blocks are aligned with the chunks, otherwise the data is indexed normally.
+
+    Arguments:
+        data [array_like] - the data, numpy array or similar like h5py or zarr dataset
+        bbs [list[tuple[slice]]] - bounding boxes of all blocks that will be read
+    Returns:
+        callable - function that takes a bounding box and returns the block
+    """
+    filters = _get_direct_chunk_filters(data, bbs)
+    if filters is None:
+        return data.__getitem__
+
+    chunks, dtype = data.chunks, data.dtype
+
+    def _read_filtered(bb):
+        offset = tuple(b.start for b in bb)
+        # the chunk was not written yet, so we need to read the fill value
+        if data.id.get_chunk_info_by_coord(offset).byte_offset is None:
+            return data[bb]
+        filter_mask, raw = data.id.read_direct_chunk(offset)
+        chunk = _decode_chunk(raw, filters, filter_mask, dtype).reshape(chunks)
+        # edge chunks are stored with the full chunk shape
+        return chunk[tuple(slice(0, b.stop - b.start) for b in bb)]
+
+    if filters:
+        return _read_filtered
+
+    def _read(bb):
+        offset = tuple(b.start for b in bb)
+        chunk = np.empty(chunks, dtype=dtype)
+        try:
+            data.id.read_direct_chunk(offset, out=chunk.reshape(-1).view("uint8"))
+        except (OSError, ValueError):
+            # the chunk was not written yet, so we need to read the fill value
+            # (if something else went wrong reading the data normally will raise the error)
+            return data[bb]
+        # edge chunks are stored with the full chunk shape
+        return chunk[tuple(slice(0, b.stop - b.start) for b in bb)]
+
+    return _read
+
+
+def get_block_writer(data, bbs):
+    """ Get function to write the blocks with the given bounding boxes to the data.
+
+    Uses direct chunk writes for hdf5 datasets that are uncompressed or gzip compressed
+    if each block covers a whole chunk, otherwise the data is assigned normally.
+
+    Arguments:
+        data [array_like] - the data, numpy array or similar like h5py or zarr dataset
+        bbs [list[tuple[slice]]] - bounding boxes of all blocks that will be written
+    Returns:
+        callable - function that takes a bounding box and the block data
+    """
+    filters = _get_direct_chunk_filters(data, bbs, full_chunks=True)
+    if filters is None:
+        return data.__setitem__
+
+    chunks, dtype = data.chunks, data.dtype
+
+    def _write(bb, block):
+        offset = tuple(b.start for b in bb)
+        if block.shape == chunks and block.dtype == dtype and block.flags.c_contiguous:
+            chunk = block
+        else:
+            # edge chunks are stored with the full chunk shape
+            chunk = np.zeros(chunks, dtype=dtype)
+            chunk[tuple(slice(0, b.stop - b.start) for b in bb)] = block
+        data.id.write_direct_chunk(offset, _encode_chunk(chunk, filters) if filters else chunk)
+
+    return _write
+
+
+def prefetch_blocks(load_block, block_ids):
+    """ Iterate over the loaded blocks, the next block is loaded in the background.
+
+    This overlaps reading the next block with processing the current one,
+    so at most two blocks are held in memory at a time.
+
+    Arguments:
+        load_block [callable] - function that takes a block id and returns the loaded block
+        block_ids [Sequence[int]] - ids of the blocks to load
+    Returns:
+        generator - yields the block id and the loaded block
+    """
+    if len(block_ids) == 0:
+        return
+    with futures.ThreadPoolExecutor(1) as loader:
+        next_block = loader.submit(load_block, block_ids[0])
+        for i, block_id in enumerate(block_ids):
+            block = next_block.result()
+            if i + 1 < len(block_ids):
+                next_block = loader.submit(load_block, block_ids[i + 1])
+            yield block_id, block
@@ -0,0 +1,137 @@
+# compiled per-block kernels for the parallel operations,
+# we fall back to plain numpy if numba is not available
+try:
+    import numba
+    from numba import types
+except ImportError:
+    numba = None
+import numpy as np
+
+# the dtypes and dimensions for which we compile the kernels,
+# for all other inputs we fall back to numpy
+_KERNEL_DTYPES = ("float32", "float64", "int32", "int64", "uint8", "uint64")
+_KERNEL_NDIMS = (2, 3)
+
+_KERNEL_UFUNCS = [np.add, np.subtract, np.multiply, np.divide,
+                  np.greater, np.greater_equal, np.less, np.less_equal,
+                  np.minimum, np.maximum]
+# comparison kernels can also write to a boolean output
+_COMPARISON_UFUNCS = [np.greater, np.greater_equal, np.less, np.less_equal]
+
+
+def _kernel_keys(ufunc):
+    keys = [(dtype, dtype, ndim) for dtype in _KERNEL_DTYPES for ndim in _KERNEL_NDIMS]
+    if ufunc in _COMPARISON_UFUNCS:
+        keys.extend([(dtype, "bool", ndim) for dtype in _KERNEL_DTYPES for ndim in _KERNEL_NDIMS])
+    return keys
+
+
+def _kernel_signature(dtype, out_dtype, ndim):
+    # the operands are read-only, so that we can pass broadcast views for scalar operands
+    operand = types.Array(numba.from_dtype(np.dtype(dtype)), ndim, "A", readonly=True)
+    out = types.Array(numba.from_dtype(np.dtype(out_dtype)), ndim, "A")
+    mask = types.Array(types.boolean, ndim, "A")
+    return types.void(operand, operand, mask, out)
+
+
+def _make_masked_kernel(ufunc, dtype, out_dtype, ndim):
+    # serial loop that releases the GIL: the parallelisation happens over the blocks
+    # error_model="numpy" gives us numpy semantics for division by zero
+    @numba.njit(_kernel_signature(dtype, out_dtype, ndim), nogil=True, cache=True, error_model="numpy")
+    def _kernel(x, y, mask, out):
+        for idx in np.ndindex(x.shape):
+            if mask[idx]:
+                out[idx] = ufunc(x[idx], y[idx])
+    return _kernel
+
+
+def _flat_kernel_signature(dtype, out_dtype):
+    x = types.Array(numba.from_dtype(np.dtype(dtype)), 1, "C", readonly=True)
+    # y is not contiguous if it is the broadcast view of a scalar
+    y = types.Array(numba.from_dtype(np.dtype(dtype)), 1, "A", readonly=True)
+    mask = types.Array(types.boolean, 1, "C")
+    out = types.Array(numba.from_dtype(np.dtype(out_dtype)), 1, "C")
+    return types.void(x, y, mask, out)
+
+
+def _make_flat_masked_kernel(ufunc, dtype, out_dtype):
+    # for contiguous blocks we read the mask as 64 bit words, so that we check 8 pixels at once
+    # and skip over the empty parts of sparse masks quickly
+    @numba.njit(_flat_kernel_signature(dtype, out_dtype), nogil=True, cache=True, error_model="numpy")
+    def _kernel(x, y, mask, out):
+        n_pixels = x.size
+        n_words = n_pixels // 8
+        words = mask[:8 * n_words].view(np.uint64)
+        for word_id in range(n_words):
+            if words[word_id] == 0:
+                continue
+            for i in range(8 * word_id, 8 * word_id + 8):
+                if mask[i]:
+                    out[i] = ufunc(x[i], y[i])
+        for i in range(8 * n_words, n_pixels):
+            if mask[i]:
+                out[i] = ufunc(x[i], y[i])
+    return _kernel
+
+
+# each kernel is compiled only for the dtypes and dimension it is requested for, when it is requested
+# for the first time (and then cached on disk), so that importing elf.parallel does not trigger any compilation
+_MASKED_KERNELS = {}
+_FLAT_MASKED_KERNELS = {}
+_KERNEL_KEYS = {} if numba is None else {ufunc: set(_kernel_keys(ufunc)) for ufunc in _KERNEL_UFUNCS}
+
+
+def get_masked_kernel(operation, dtype, out_dtype, ndim):
+    """ Get the compiled kernel applying operation to the masked pixels of a block.
+
+    The kernel has the signature kernel(x, y, mask, out) and writes
+    operation(x, y) to out where mask is True, out may be the same array as x.
+    x and y must have the same shape and the given dtype, mask must be boolean.
+    A scalar y can be passed as a broadcast view.
+
+    Arguments:
+        operation [callable] - the operation
+        dtype [np.dtype] - dtype of the operands
+        out_dtype [np.dtype] - dtype of the output
+        ndim [int] - number of dimensions of the operands
+    Returns:
+        callable - the kernel or None if it is not available for this operation and these types
+    """
+    keys = _KERNEL_KEYS.get(operation, None)
+    dtype, out_dtype = np.dtype(dtype), np.dtype(out_dtype)
+    # the kernels are only compiled for native byte order, e.g. big-endian data is processed with numpy
+    if keys is None or not (dtype.isnative and out_dtype.isnative):
+        return None
+    key = (dtype.name, out_dtype.name, ndim)
+    if key not in keys:
+        return None
+    kernel = _MASKED_KERNELS.get((operation,) + key, None)
+    if kernel is None:
+        kernel = _MASKED_KERNELS.setdefault((operation,) + key, _make_masked_kernel(operation, *key))
+    return kernel
+
+
+def get_flat_masked_kernel(operation, dtype, out_dtype):
+    """ Get the compiled kernel applying operation to the masked pixels of a contiguous block.
+
+    Same as get_masked_kernel, but for flattened blocks: x, mask and out must be
+    1d and C-contiguous, y must be 1d (e.g. the flattened broadcast view of a scalar).
+
+    Arguments:
+        operation [callable] - the operation
+        dtype [np.dtype] - dtype of the operands
+        out_dtype [np.dtype] - dtype of the output
+    Returns:
+        callable - the kernel or None if it is not available for this operation and these types
+    """
+    keys = _KERNEL_KEYS.get(operation, None)
+    dtype, out_dtype = np.dtype(dtype), np.dtype(out_dtype)
+    if keys is None or not (dtype.isnative and out_dtype.isnative):
+        return None
+    key = (dtype.name, out_dtype.name)
+    if key + (_KERNEL_NDIMS[0],) not in keys:
+        return None
+    kernel = _FLAT_MASKED_KERNELS.get((operation,) + key, None)
+    if kernel is None:
+        kernel = _FLAT_MASKED_KERNELS.setdefault((operation,) + key, _make_flat_masked_kernel(operation, *key))
+    return kernel
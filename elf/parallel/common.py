@@ -1,8 +1,9 @@
 import nifty.tools as nt
+import numpy as np
 from ..util import normalize_index
 
 
-def get_blocking(data, block_shape, roi):
+def get_block_shape_and_roi(data, block_shape, roi):
     if block_shape is None:
         try:
             block_shape = data.chunks
@@ -20,5 +21,32 @@ def get_blocking(data, block_shape, roi):
             raise ValueError("Invalid roi")
         roi_begin = [bb.start for bb in roi_normalized]
         roi_end = [bb.stop for bb in roi_normalized]
+    return block_shape, roi_begin, roi_end
+
+
+def get_blocking(data, block_shape, roi):
+    block_shape, roi_begin, roi_end = get_block_shape_and_roi(data, block_shape, roi)
     blocking = nt.blocking(roi_begin, roi_end, block_shape)
     return blocking
+
+
+def get_blocks(data, block_shape, roi):
+    """ Get the begin and end coordinates of all blocks.
+
+    Computes the same blocks as get_blocking in a single numpy call instead of
+    requesting them one by one from the blocking. The blocks are in C-order.
+
+    Arguments:
+        data [array_like] - the data
+        block_shape [tuple] - shape of the blocks, by default chunks of the data will be used
+        roi [tuple[slice]] - region of interest
+    Returns:
+        np.ndarray - begin coordinates of the blocks (n_blocks x ndim)
+        np.ndarray - end coordinates of the blocks (n_blocks x ndim)
+    """
+    block_shape, roi_begin, roi_end = get_block_shape_and_roi(data, block_shape, roi)
+    axes = [np.arange(beg, end, bs) for beg, end, bs in zip(roi_begin, roi_end, block_shape)]
+    grid = np.meshgrid(*axes, indexing="ij")
+    begins = np.stack([g.ravel() for g in grid], axis=1)
+    ends = np.minimum(begins + np.array(block_shape), np.array(roi_end))
+    return begins, ends
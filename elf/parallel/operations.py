@@ -1,4 +1,6 @@
 import multiprocessing
+import os
+import threading
 # would be nice to use dask for all of this instead of concurrent.futures
 # so that this could be used on a cluster as well
 from concurrent import futures
@@ -6,11 +8,30 @@ from numbers import Number
 from functools import partial
 from tqdm import tqdm
 
-from .common import get_blocking
+from .common import get_block_shape_and_roi, get_blocks
+from ._chunk_io import get_block_reader, get_block_writer, prefetch_blocks
+from ._kernels import get_flat_masked_kernel, get_masked_kernel
 from ..util import set_numpy_threads
 set_numpy_threads(1)
 import numpy as np
 
+# number of cpus available to this process, which can be less than the number of cpus
+# of the machine, e.g. in a container or a slurm job
+_N_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else multiprocessing.cpu_count()
+
+# number of tasks per thread in apply_operation, each task processes a range of blocks
+_TASKS_PER_THREAD = 4
+
+# blocks smaller than this are processed with the compiled masked kernels, larger blocks with numpy
+_SMALL_BLOCK_SIZE = 1 << 14
+
+# number of blocks along the first axis for which the mask is loaded at once in compute_mask_occupancy
+_BLOCKS_PER_MASK_LOAD = 8
+
+# approximate number of pixels for which an expression is evaluated at once in Expr.compute,
+# so that the intermediate results stay in the cache
+_TILE_SIZE = 1 << 16
+
 
 def _compute_broadcast(shapex, shapey):
     broadcast = []
@@ -24,6 +45,123 @@ def _compute_broadcast(shapex, shapey):
     return broadcast
 
 
+def compute_mask_occupancy(mask, block_shape=None, n_threads=None, verbose=False, roi=None):
+    """ Compute which blocks contain pixels in the mask.
+
+    The result can be passed as mask_occupancy to apply_operation (and the operations derived from it)
+    to skip empty blocks without loading the mask for them. This is useful when applying several
+    operations with the same mask. The same block_shape and roi must be used for all of these calls.
+
+    Arguments:
+        mask [array_like] - the mask, numpy array or similar like h5py or zarr dataset
+        block_shape [tuple] - shape of the blocks used for parallelisation,
+            by default chunks of the mask will be used, if available (default: None)
+        n_threads [int] - number of threads, by default all are used (default: None)
+        verbose [bool] - verbosity flag (default: False)
+        roi [tuple[slice]] - region of interest for this computation (default: None)
+    Returns:
+        np.ndarray - boolean array indicating for each block if it contains mask pixels
+    """
+    block_shape, roi_begin, roi_end = get_block_shape_and_roi(mask, block_shape, roi)
+    block_shape = list(block_shape)
+    grid_shape = tuple((end - beg + bs - 1) // bs for beg, end, bs in zip(roi_begin, roi_end, block_shape))
+    occupancy_grid = np.zeros(grid_shape, dtype="bool")
+
+    # we load the mask for several blocks along the first axis at once
+    # and reduce them via a reshape, to avoid loading the mask block by block
+    load_shape = [block_shape[0] * _BLOCKS_PER_MASK_LOAD] + block_shape[1:]
+    load_bbs = _get_bounding_boxes(mask, load_shape, roi)
+    n_loads = len(load_bbs)
+    # we don't need more threads than loads
+    n_threads = min(_N_CPUS if n_threads is None else n_threads, max(n_loads, 1))
+
+    def _occupancy(load_id):
+        bb = load_bbs[load_id]
+        m = mask[bb]
+
+        # pad to a multiple of the block shape, so that we can reshape
+        pad_width = [(0, -sh % bs) for sh, bs in zip(m.shape, block_shape)]
+        if any(pad[1] > 0 for pad in pad_width):
+            m = np.pad(m, pad_width)
+        reshaped = []
+        for sh, bs in zip(m.shape, block_shape):
+            reshaped.extend([sh // bs, bs])
+        occupancy = m.reshape(tuple(reshaped)).any(axis=tuple(range(1, len(reshaped), 2)))
+
+        grid_bb = tuple(slice((b.start - rb) // bs, (b.start - rb) // bs + n_grid)
+                        for b, rb, bs, n_grid in zip(bb, roi_begin, block_shape, occupancy.shape))
+        occupancy_grid[grid_bb] = occupancy
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        if verbose:
+            list(tqdm(tp.map(_occupancy, range(n_loads)), total=n_loads))
+        else:
+            list(tp.map(_occupancy, range(n_loads)))
+
+    # the blocks are in C-order, so the block ids correspond to the flattened grid
+    return occupancy_grid.ravel()
+
+
+def _get_bounding_boxes(data, block_shape, roi):
+    begins, ends = get_blocks(data, block_shape, roi)
+    return [tuple(slice(beg, end) for beg, end in zip(block_begin, block_end))
+            for block_begin, block_end in zip(begins.tolist(), ends.tolist())]
+
+
+def _apply_in_ranges(load_block, compute_block, n_blocks, n_threads, verbose, prefetch=False):
+    # submit the blocks in ranges instead of one task per block to reduce the scheduling overhead,
+    # we still use several ranges per thread so that the work is balanced between the threads
+    range_size = max(1, n_blocks // (n_threads * _TASKS_PER_THREAD))
+
+    def _apply_range(begin, end):
+        # if the inputs are read from disk, the next block is read while the current one is computed
+        if prefetch:
+            for block_id, inputs in prefetch_blocks(load_block, range(begin, end)):
+                compute_block(block_id, inputs)
+        else:
+            for block_id in range(begin, end):
+                compute_block(block_id, load_block(block_id))
+        return end - begin
+
+    # the tasks are submitted while the previous ones are processed, with a bounded number of tasks
+    # in flight, and the progress is updated as soon as a task is done
+    in_flight = threading.Semaphore(2 * n_threads)
+    errors = []
+    with tqdm(total=n_blocks, disable=not verbose) as pbar, futures.ThreadPoolExecutor(n_threads) as tp:
+
+        def _task_done(task):
+            in_flight.release()
+            if task.exception() is None:
+                pbar.update(task.result())
+            else:
+                errors.append(task.exception())
+
+        for begin in range(0, n_blocks, range_size):
+            in_flight.acquire()
+            # stop submitting if a task has failed
+            if errors:
+                break
+            task = tp.submit(_apply_range, begin, min(begin + range_size, n_blocks))
+            task.add_done_callback(_task_done)
+
+    if errors:
+        raise errors[0]
+
+
+def _result_dtype(dtype, scalar):
+    try:
+        return np.result_type(dtype, scalar)
+    except (OverflowError, TypeError):
+        return None
+
+
+def _is_flat(xx, yy, m, res):
+    # check if the blocks can be flattened without copying,
+    # yy may also be the broadcast view of a scalar
+    return (xx.flags.c_contiguous and m.flags.c_contiguous and res.flags.c_contiguous and
+            (yy.flags.c_contiguous or not any(yy.strides)))
+
+
 def isin(x, y, out=None,
          block_shape=None, n_threads=None,
          mask=None, verbose=False, roi=None):
@@ -55,19 +193,19 @@ def isin(x, y, out=None,
         raise ValueError("Expect x and out of same shape, got %s and %s" % (str(x.shape),
                                                                             str(out.shape)))
 
-    n_threads = multiprocessing.cpu_count() if n_threads is None else n_threads
-    blocking = get_blocking(x, block_shape, roi)
-    n_blocks = blocking.numberOfBlocks
+    bbs = _get_bounding_boxes(x, block_shape, roi)
+    n_blocks = len(bbs)
+    # we don't need more threads than blocks
+    n_threads = min(_N_CPUS if n_threads is None else n_threads, max(n_blocks, 1))
 
     def _isin(block_id):
-        block = blocking.getBlock(block_id)
-        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+        bb = bbs[block_id]
 
         # check if we have a mask and if we do if we
         # have pixels in the mask
         if mask is not None:
-            m = mask[bb].astype('bool')
-            if m.sum() == 0:
+            m = mask[bb].astype('bool', copy=False)
+            if not m.any():
                 return None
 
         # load the data and apply the mask if given
@@ -89,7 +227,8 @@ def isin(x, y, out=None,
 
 def apply_operation(x, y, operation, out=None,
                     block_shape=None, n_threads=None,
-                    mask=None, verbose=False, roi=None):
+                    mask=None, verbose=False, roi=None,
+                    mask_occupancy=None):
     """ Apply operation to two operands in parallel.
 
     Arguments:
@@ -105,6 +244,9 @@ def apply_operation(x, y, operation, out=None,
         mask [array_like] - mask to exclude data from the computation (default: None)
         verbose [bool] - verbosity flag (default: False)
         roi [tuple[slice]] - region of interest for this computation (default: None)
+        mask_occupancy [np.ndarray] - which blocks contain pixels in the mask,
+            see compute_mask_occupancy. Must be computed with the same block_shape and roi,
+            if not given the mask is checked block by block (default: None)
     Returns:
         array_like - output
     """
@@ -123,10 +265,6 @@ def apply_operation(x, y, operation, out=None,
         # if the shapes disagree, check if we can broadcast
         broadcast = False if x.shape == y.shape else _compute_broadcast(x.shape, y.shape)
 
-    # broadcasting and masking is not supported yet
-    if mask is not None and broadcast:
-        raise NotImplementedError("Broadcasting and masking is not implemented yet")
-
     # check the mask if given
     if mask is not None and mask.shape != x.shape:
         raise ValueError("Invalid mask shape, got %s, expected %s (= shape of first operand)" % (str(mask.shape),
@@ -138,60 +276,126 @@ def apply_operation(x, y, operation, out=None,
         raise ValueError("Expect x and out of same shape, got %s and %s" % (str(x.shape),
                                                                             str(out.shape)))
 
-    n_threads = multiprocessing.cpu_count() if n_threads is None else n_threads
-    blocking = get_blocking(x, block_shape, roi)
-    n_blocks = blocking.numberOfBlocks
-
-    def _apply_scalar(block_id):
-        block = blocking.getBlock(block_id)
-        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
-
-        # check if we have a mask and if we do if we
-        # have pixels in the mask
-        if mask is not None:
-            m = mask[bb].astype('bool')
-            if m.sum() == 0:
-                return None
+    # precompute the bounding boxes of all blocks, so that the workers only need to look them up
+    bbs = _get_bounding_boxes(x, block_shape, roi)
+    n_blocks = len(bbs)
+    # we don't need more threads than blocks
+    n_threads = min(_N_CPUS if n_threads is None else n_threads, max(n_blocks, 1))
 
-        # load the data and apply the mask if given
-        xx = x[bb]
-        if mask is None:
-            xx = operation(xx, y)
+    if mask_occupancy is not None and len(mask_occupancy) != n_blocks:
+        raise ValueError("Invalid mask occupancy, got %i blocks, expected %i" % (len(mask_occupancy), n_blocks))
+    # treat a scalar operand as 0-d array with the dtype it is promoted to in the operation,
+    # so that scalar and array operands are processed in the same way
+    if scalar_operand:
+        y = np.asarray(y, dtype=_result_dtype(x.dtype, y))
+        bbys = n_blocks * [()]
+    # change the bounding boxes if inputs need to be broadcast
+    elif broadcast:
+        bbys = [tuple(slice(None) if bcast else b for bcast, b in zip(broadcast, bb)) for bb in bbs]
+    else:
+        bbys = bbs
+
+    # fused kernel for the masked pixels of small blocks
+    # the kernels are only available if both operands have the same dtype, otherwise we use numpy
+    masked_kernel, flat_masked_kernel = None, None
+    if mask is not None and y.dtype == x.dtype:
+        masked_kernel = get_masked_kernel(operation, x.dtype, out.dtype, x.ndim)
+        flat_masked_kernel = get_flat_masked_kernel(operation, x.dtype, out.dtype)
+
+    # read and write chunk-aligned blocks of unfiltered hdf5 datasets with direct chunk access
+    read_x = get_block_reader(x, bbs)
+    read_mask = None if mask is None else get_block_reader(mask, bbs)
+    write_out = get_block_writer(out, bbs)
+
+    def _load_mask(block_id, bb):
+        # check if we have pixels in the mask for this block
+        if mask_occupancy is not None and not mask_occupancy[block_id]:
+            return None
+        # the mask block is only copied if it is not boolean already
+        m = read_mask(bb).astype('bool', copy=False)
+        if mask_occupancy is None and not m.any():
+            return None
+        return m
+
+    # for numpy outputs, numpy ufuncs write their result directly into the output block,
+    # instead of creating a temporary result that is then copied to the output
+    out_is_array = isinstance(out, np.ndarray)
+    is_ufunc = isinstance(operation, np.ufunc)
+    write_direct = out_is_array and is_ufunc
+    # if out is (a view of) y, we must not overwrite it with x before the computation,
+    # so the values outside of the mask are copied from x afterwards
+    fill_after = out_is_array and out is not x and np.may_share_memory(out, y)
+
+    def _compute(xx, yy, bb):
+        if write_direct:
+            operation(xx, yy, out=out[bb], casting="unsafe")
         else:
-            xx[m] = operation(xx[m], y)
-        out[bb] = xx
-
-    def _apply_array(block_id):
-        block = blocking.getBlock(block_id)
-        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
-        # change the bounding boxes if inputs need to be broadcast
-        if broadcast:
-            bby = tuple(slice(None) if bcast else b for bcast, b in zip(broadcast, bb))
+            write_out(bb, operation(xx, yy))
+
+    def _compute_masked(xx, yy, m, bb):
+        # get the buffer for the result, the values outside of the mask are taken from x
+        if out_is_array:
+            res = out[bb]
+            if out is not x and not fill_after:
+                res[...] = xx
         else:
-            bby = bb
-
-        # check if we have a mask and if we do if we
-        # have pixels in the mask
-        if mask is not None:
-            m = mask[bb].astype('bool')
-            if m.sum() == 0:
-                return None
-
-        # load the data and apply the mask if given
-        xx = x[bb]
-        yy = y[bby]
-        if mask is None:
-            xx = operation(xx, yy)
+            # we must not write to xx if it is a view into x
+            res = xx.copy() if isinstance(x, np.ndarray) else xx
+
+        # contiguous blocks (e.g. loaded from chunked datasets) are processed with the flat kernel,
+        # which is faster than numpy for dense masks and skips over empty parts of sparse masks
+        if flat_masked_kernel is not None and _is_flat(xx, yy, m, res):
+            flat_masked_kernel(xx.reshape(-1), yy.reshape(-1), m.reshape(-1), res.reshape(-1))
+        # otherwise the compiled kernel has less call overhead than numpy for small blocks,
+        # for large blocks the vectorized numpy loop is faster
+        elif masked_kernel is not None and xx.size < _SMALL_BLOCK_SIZE:
+            masked_kernel(xx, yy, m, res)
+        elif is_ufunc:
+            operation(xx, yy, out=res, where=m, casting="unsafe")
         else:
-            xx[m] = operation(xx[m], yy[m])
-        out[bb] = xx
+            res[m] = operation(xx[m], yy[m])
+
+        if fill_after:
+            np.copyto(res, xx, where=~m, casting="unsafe")
+        if not out_is_array:
+            write_out(bb, res)
+
+    def _load(block_id):
+        return read_x(bbs[block_id])
+
+    def _load_masked(block_id):
+        bb = bbs[block_id]
+        m = _load_mask(block_id, bb)
+        if m is None:
+            return None
+        return read_x(bb), m
+
+    def _apply(block_id, xx):
+        bb = bbs[block_id]
+        _compute(xx, y[bbys[block_id]], bb)
+
+    def _apply_masked(block_id, inputs):
+        if inputs is None:
+            return None
+        xx, m = inputs
+        # broadcast the second operand to the block shape (this does not copy it)
+        yy = np.broadcast_to(y[bbys[block_id]], xx.shape)
+        _compute_masked(xx, yy, m, bbs[block_id])
+
+    # select the block functions once, so that the workers don't need to check for the mask
+    if mask is None:
+        _load_block, _apply_block = _load, _apply
+    else:
+        _load_block, _apply_block = _load_masked, _apply_masked
+    # prefetching only pays off if reading the inputs is slow, i.e. not for in-memory numpy arrays
+    prefetch = not (isinstance(x, np.ndarray) and (mask is None or isinstance(mask, np.ndarray)))
 
-    _apply = _apply_scalar if scalar_operand else _apply_array
-    with futures.ThreadPoolExecutor(n_threads) as tp:
-        if verbose:
-            list(tqdm(tp.map(_apply, range(n_blocks)), total=n_blocks))
-        else:
-            tp.map(_apply, range(n_blocks))
+    # we use threads and not processes here, also for in-memory numpy operands:
+    # numpy releases the GIL in the ufunc loops, so the per-block compute runs in parallel,
+    # whereas a process pool would need to copy x, y and out into shared memory first,
+    # which costs a full pass over the data before any block is processed.
+    # for h5py, zarr etc. the I/O releases the GIL as well.
+    _apply_in_ranges(_load_block, _apply_block, n_blocks, n_threads, verbose, prefetch=prefetch)
 
     return out
 
@@ -234,19 +438,19 @@ def apply_operation_single(x, operation, axis=None, out=None,
     if shape != out.shape:
         raise ValueError("Expect x and out of same shape, got %s and %s" % (str(shape), str(out.shape)))
 
-    n_threads = multiprocessing.cpu_count() if n_threads is None else n_threads
-    blocking = get_blocking(out, block_shape, roi)
-    n_blocks = blocking.numberOfBlocks
+    bbs = _get_bounding_boxes(out, block_shape, roi)
+    n_blocks = len(bbs)
+    # we don't need more threads than blocks
+    n_threads = min(_N_CPUS if n_threads is None else n_threads, max(n_blocks, 1))
 
     def _apply(block_id):
-        block = blocking.getBlock(block_id)
-        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+        bb = bbs[block_id]
 
         # check if we have a mask and if we do if we
         # have pixels in the mask
         if mask is not None:
-            m = mask[bb].astype('bool')
-            if m.sum() == 0:
+            m = mask[bb].astype('bool', copy=False)
+            if not m.any():
                 return None
 
         if axis is None:
@@ -269,9 +473,194 @@ def apply_operation_single(x, operation, axis=None, out=None,
     return out
 
 
+def _get_broadcast_reader(data, broadcast):
+    def _read(bb):
+        return data[tuple(slice(None) if bcast else b for bcast, b in zip(broadcast, bb))]
+    return _read
+
+
+class Expr:
+    """ Lazy expression of block-wise operations.
+
+    The operations (add, multiply, less, etc.) return a new Expr instead of computing the result
+    if one of the operands is an Expr. The expression is then computed with compute in a single pass
+    over the data, without creating temporary arrays of the full shape.
+
+    Arguments:
+        data [array_like] - the operand, numpy array or similar like h5py or zarr dataset
+    """
+
+    def __init__(self, data):
+        self.op_name = None
+        self.operands = (data,)
+        self.shape, self.ndim, self.dtype = data.shape, data.ndim, np.dtype(data.dtype)
+
+    @classmethod
+    def _from_operation(cls, op_name, x, y):
+        if isinstance(x, Number):
+            raise ValueError("Expected first operand to be an array or expression, got %s" % type(x))
+        x = x if isinstance(x, Expr) else cls(x)
+        # scalar operands are stored as 0-d array with the dtype they are promoted to, like in apply_operation
+        if isinstance(y, Number):
+            y = np.asarray(y, dtype=_result_dtype(x.dtype, y))
+        else:
+            y = y if isinstance(y, Expr) else cls(y)
+            if x.ndim != y.ndim:
+                raise ValueError("Dimensions of operands do not match: %i, %i" % (x.ndim, y.ndim))
+            if x.shape != y.shape:
+                _compute_broadcast(x.shape, y.shape)
+
+        expr = cls.__new__(cls)
+        expr.op_name, expr.operands = op_name, (x, y)
+        expr.shape, expr.ndim = x.shape, x.ndim
+        expr.dtype = getattr(np, op_name)(np.empty(0, dtype=x.dtype), np.empty(0, dtype=y.dtype)).dtype
+        return expr
+
+    @property
+    def chunks(self):
+        for leaf in self._leaves().values():
+            chunks = getattr(leaf, "chunks", None)
+            if chunks is not None:
+                return chunks
+        raise AttributeError("None of the operands of the expression has chunks")
+
+    def _leaves(self):
+        # the array operands of the expression, by their id
+        if self.op_name is None:
+            return {id(self.operands[0]): self.operands[0]}
+        leaves = {}
+        for operand in self.operands:
+            if isinstance(operand, Expr):
+                leaves.update(operand._leaves())
+        return leaves
+
+    def _evaluate(self, blocks, out=None):
+        # evaluate the expression with numpy, blocks maps the ids of the leaves to their blocks
+        if self.op_name is None:
+            block = blocks[id(self.operands[0])]
+            if out is None:
+                return block
+            out[...] = block
+            return out
+        x, y = (operand._evaluate(blocks) if isinstance(operand, Expr) else operand for operand in self.operands)
+        if out is None:
+            return getattr(np, self.op_name)(x, y)
+        return getattr(np, self.op_name)(x, y, out=out, casting="unsafe")
+
+    def compute(self, out=None, block_shape=None, n_threads=None,
+                mask=None, verbose=False, roi=None, mask_occupancy=None):
+        """ Compute the expression block-wise and in parallel.
+
+        Arguments:
+            out [array_like] - output, by default a numpy array is allocated (default: None)
+            block_shape [tuple] - shape of the blocks used for parallelisation,
+                by default chunks of the operands will be used, if available (default: None)
+            n_threads [int] - number of threads, by default all are used (default: None)
+            mask [array_like] - mask to exclude data from the computation, like in apply_operation
+                out gets the values of the first operand outside of the mask (default: None)
+            verbose [bool] - verbosity flag (default: False)
+            roi [tuple[slice]] - region of interest for this computation (default: None)
+            mask_occupancy [np.ndarray] - which blocks contain pixels in the mask,
+                see compute_mask_occupancy (default: None)
+        Returns:
+            array_like - output
+        """
+        if out is None:
+            out = np.zeros(self.shape, dtype=self.dtype)
+        elif out.shape != self.shape:
+            raise ValueError("Expect expression and out of same shape, got %s and %s" % (str(self.shape),
+                                                                                        str(out.shape)))
+        if mask is not None and mask.shape != self.shape:
+            raise ValueError("Invalid mask shape, got %s, expected %s" % (str(mask.shape), str(self.shape)))
+
+        bbs = _get_bounding_boxes(self, block_shape, roi)
+        n_blocks = len(bbs)
+        # we don't need more threads than blocks
+        n_threads = min(_N_CPUS if n_threads is None else n_threads, max(n_blocks, 1))
+        if mask_occupancy is not None and len(mask_occupancy) != n_blocks:
+            raise ValueError("Invalid mask occupancy, got %i blocks, expected %i" % (len(mask_occupancy), n_blocks))
+
+        # get the block reader for all array operands, broadcast operands are indexed normally
+        leaves = self._leaves()
+        readers = {}
+        for leaf_id, leaf in leaves.items():
+            if leaf.shape == self.shape:
+                readers[leaf_id] = get_block_reader(leaf, bbs)
+            else:
+                readers[leaf_id] = _get_broadcast_reader(leaf, _compute_broadcast(self.shape, leaf.shape))
+        read_mask = None if mask is None else get_block_reader(mask, bbs)
+        write_out = get_block_writer(out, bbs)
+        out_is_array = isinstance(out, np.ndarray)
+
+        def _evaluate(expr, blocks, res):
+            # evaluate large blocks in slabs along the first axis, so that the intermediate results
+            # of the expression stay in the cache instead of going through main memory
+            n_rows = res.shape[0]
+            tile_rows = max(1, _TILE_SIZE // (res.size // n_rows))
+            if tile_rows >= n_rows:
+                return expr._evaluate(blocks, out=res)
+            for row in range(0, n_rows, tile_rows):
+                tile = slice(row, row + tile_rows)
+                # broadcast operands have a single row, which is used for all tiles
+                tile_blocks = {leaf_id: block if block.shape[0] == 1 else block[tile]
+                               for leaf_id, block in blocks.items()}
+                expr._evaluate(tile_blocks, out=res[tile])
+            return res
+
+        # the values outside of the mask are taken from the first operand
+        first = self if self.op_name is None else self.operands[0]
+
+        def _load(block_id):
+            bb = bbs[block_id]
+            if mask is not None:
+                if mask_occupancy is not None and not mask_occupancy[block_id]:
+                    return None
+                m = read_mask(bb).astype('bool', copy=False)
+                if mask_occupancy is None and not m.any():
+                    return None
+            else:
+                m = None
+            return {leaf_id: read(bb) for leaf_id, read in readers.items()}, m
+
+        def _apply(block_id, inputs):
+            if inputs is None:
+                return None
+            blocks, m = inputs
+            bb = bbs[block_id]
+            if m is None:
+                # numpy outputs are written directly, other outputs need a temporary result
+                if out_is_array:
+                    _evaluate(self, blocks, out[bb])
+                else:
+                    shape = tuple(b.stop - b.start for b in bb)
+                    write_out(bb, _evaluate(self, blocks, np.empty(shape, dtype=out.dtype)))
+            else:
+                # all values of the block are written, so we don't need to read it for other outputs
+                res = out[bb] if out_is_array else np.empty(m.shape, dtype=out.dtype)
+                if first.op_name is None:
+                    first_values = blocks[id(first.operands[0])]
+                else:
+                    first_values = _evaluate(first, blocks, np.empty(m.shape, dtype=first.dtype))
+                np.copyto(res, first_values, where=~m, casting="unsafe")
+                np.copyto(res, _evaluate(self, blocks, np.empty(m.shape, dtype=self.dtype)), where=m, casting="unsafe")
+                if not out_is_array:
+                    write_out(bb, res)
+
+        prefetch = not (all(isinstance(leaf, np.ndarray) for leaf in leaves.values()) and
+                        (mask is None or isinstance(mask, np.ndarray)))
+        _apply_in_ranges(_load, _apply, n_blocks, n_threads, verbose, prefetch=prefetch)
+        return out
+
+
 # helper function to autogenerate parallel impls of common numpy operations
 def _generate_operation(op_name):
 
+    # comparisons are only written to boolean outputs, so that the result is not cast to the dtype of x
+    is_comparison = op_name in _comparison_names
+    comparison_note = ""
+    if is_comparison:
+        comparison_note = "\n\n        The output must be boolean, i.e. out must be given unless x is boolean."
+
     doc_str =\
         """Apply np.%s block-wise and in parallel.
 
@@ -286,15 +675,36 @@ def _generate_operation(op_name):
             mask [array_like] - mask to exclude data from the computation (default: None)
             verbose [bool] - verbosity flag (default: False)
             roi [tuple[slice]] - region of interest for this computation (default: None)
+            mask_occupancy [np.ndarray] - which blocks contain pixels in the mask,
+                see compute_mask_occupancy (default: None)
         Returns:
             array_like - output
-        """ % op_name
+
+        If x or y is an Expr, the operation is not computed but returned as new Expr,
+        unless out is given; then the whole expression is computed into out.%s
+        """ % (op_name, comparison_note)
 
     def op(x, y, out=None, block_shape=None, n_threads=None,
-           mask=None, verbose=False, roi=None):
+           mask=None, verbose=False, roi=None, mask_occupancy=None):
+        expr = None
+        if isinstance(x, Expr) or isinstance(y, Expr):
+            expr = Expr._from_operation(op_name, x, y)
+            if out is None:
+                if mask is not None or roi is not None or mask_occupancy is not None:
+                    raise ValueError("Lazy expressions can only be computed with a mask or roi if out is given")
+                return expr
+
+        if is_comparison:
+            out_dtype = np.dtype((x if out is None else out).dtype)
+            if out_dtype != np.dtype("bool"):
+                raise ValueError("Expect boolean output for %s, got %s" % (op_name, str(out_dtype)))
+
+        if expr is not None:
+            return expr.compute(out=out, block_shape=block_shape, n_threads=n_threads, mask=mask,
+                                verbose=verbose, roi=roi, mask_occupancy=mask_occupancy)
         return apply_operation(x, y, getattr(np, op_name), block_shape=block_shape,
                                n_threads=n_threads, mask=mask, verbose=verbose,
-                               out=out, roi=roi)
+                               out=out, roi=roi, mask_occupancy=mask_occupancy)
 
     op.__doc__ = doc_str
     op.__name__ = op_name
@@ -302,9 +712,9 @@ def _generate_operation(op_name):
 
 
 # autogenerate parallel implementation for common numpy operations
+_comparison_names = ['greater', 'greater_equal', 'less', 'less_equal']
 _op_names = ['add', 'subtract', 'multiply', 'divide',
-             'greater', 'greater_equal', 'less', 'less_equal',
-             'minimum', 'maximum']
+             'minimum', 'maximum'] + _comparison_names
 
 
 for op_name in _op_names:
@@ -312,6 +722,7 @@ for op_name in _op_names:
 
 del _generate_operation
 del _op_names
+del _comparison_names
 
 
 # TODO autogenerate parallel implementation for common single operand numpy operations
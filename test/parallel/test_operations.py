@@ -1,4 +1,7 @@
+import os
 import unittest
+from shutil import rmtree
+
 import numpy as np
 
 try:
@@ -6,9 +9,22 @@ try:
 except ImportError:
     nifty = None
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
 
 @unittest.skipUnless(nifty, "Need nifty")
 class TestOperations(unittest.TestCase):
+    tmp_folder = './tmp'
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
     def _test_op_array(self, op, op_exp, inplace):
         shape = 3 * (64,)
         block_shape = 3 * (16,)
@@ -53,19 +69,56 @@ class TestOperations(unittest.TestCase):
         y = np.random.rand(*shapey)
 
         exp = op_exp(x, y)
+        mask = np.random.rand(*shapex) > .5
+        exp_masked = x.copy()
+        exp_masked[mask] = exp[mask]
+
+        res = op(x.copy(), y, block_shape=block_shape, mask=mask)
+        self.assertTrue(np.allclose(exp_masked, res))
+
         op(x, y, block_shape=block_shape)
         self.assertTrue(np.allclose(exp, x))
 
-    def _test_op_masked(self, op, op_exp):
+    def _test_op_masked(self, op, op_exp, scalar, block_shape=3 * (16,)):
+        shape = 3 * (64,)
+        x = np.random.rand(*shape)
+        y = np.random.rand() if scalar else np.random.rand(*shape)
+        mask = np.random.rand(*shape) > .5
+
+        exp = x.copy()
+        exp[mask] = op_exp(x[mask], y if scalar else y[mask])
+
+        x_cpy = x.copy()
+        res = np.zeros_like(x)
+        res = op(x, y, out=res, block_shape=block_shape, mask=mask)
+        self.assertTrue(np.allclose(exp, res))
+        # make sure x is unchaged
+        self.assertTrue(np.allclose(x, x_cpy))
+
+        # the output can also be the second operand
+        if not scalar:
+            y_cpy = y.copy()
+            res = op(x, y_cpy, out=y_cpy, block_shape=block_shape, mask=mask)
+            self.assertTrue(np.allclose(exp, res))
+
+        op(x, y, block_shape=block_shape, mask=mask)
+        self.assertTrue(np.allclose(exp, x))
+
+    def _test_op_mask_occupancy(self, op, op_exp):
+        from elf.parallel import compute_mask_occupancy
         shape = 3 * (64,)
         block_shape = 3 * (16,)
         x = np.random.rand(*shape)
         y = np.random.rand()
-        mask = np.random.rand(*shape) > .5
+        mask = np.zeros(shape, dtype="bool")
+        mask[:16, 20:40] = np.random.rand(16, 20, 64) > .5
+
+        occupancy = compute_mask_occupancy(mask, block_shape=block_shape)
+        self.assertEqual(occupancy.sum(), 8)
 
         exp = x.copy()
         exp[mask] = op_exp(x[mask], y)
-        op(x, y, block_shape=block_shape, mask=mask)
+        op(x, y, block_shape=block_shape, mask=mask, mask_occupancy=occupancy)
         self.assertTrue(np.allclose(exp, x))
 
     def _test_op_roi(self, op, op_exp):
@@ -92,9 +145,51 @@ class TestOperations(unittest.TestCase):
         self._test_op_scalar(op1, op2, True)
         self._test_op_scalar(op1, op2, False)
         self._test_op_broadcast(op1, op2)
-        self._test_op_masked(op1, op2)
+        self._test_op_masked(op1, op2, True)
+        self._test_op_masked(op1, op2, False)
+        # large blocks are processed with numpy instead of the compiled kernels
+        self._test_op_masked(op1, op2, True, block_shape=3 * (32,))
+        # blocks that are contiguous in memory are processed with the flat kernels
+        self._test_op_masked(op1, op2, True, block_shape=(5, 64, 64))
+        self._test_op_masked(op1, op2, False, block_shape=(5, 64, 64))
+        self._test_op_mask_occupancy(op1, op2)
         self._test_op_roi(op1, op2)
 
+    def _test_comparison(self, op, op_exp):
+        shape = 3 * (64,)
+        block_shape = 3 * (16,)
+        x = np.random.rand(*shape)
+        x_cpy = x.copy()
+
+        for y in (np.random.rand(*shape), np.random.rand(1, 64, 64), np.random.rand()):
+            exp = op_exp(x, y)
+            res = np.zeros(shape, dtype='bool')
+            res = op(x, y, out=res, block_shape=block_shape)
+            self.assertTrue(np.array_equal(exp, res))
+            self.assertTrue(np.allclose(x, x_cpy))
+
+            # the values outside of the mask are taken from x
+            mask = np.random.rand(*shape) > .5
+            for mask_block_shape in (block_shape, (5, 64, 64)):
+                exp_masked = x.astype('bool')
+                exp_masked[mask] = exp[mask]
+                res = np.zeros(shape, dtype='bool')
+                res = op(x, y, out=res, block_shape=mask_block_shape, mask=mask)
+                self.assertTrue(np.array_equal(exp_masked, res))
+
+        roi = np.s_[2:31, 5:59]
+        y = np.random.rand()
+        res = np.zeros(shape, dtype='bool')
+        op(x, y, out=res, block_shape=block_shape, roi=roi)
+        self.assertTrue(np.array_equal(op_exp(x[roi], y), res[roi]))
+        self.assertEqual(res.sum(), res[roi].sum())
+
+        # comparisons need a boolean output
+        with self.assertRaises(ValueError):
+            op(x, y, block_shape=block_shape)
+        with self.assertRaises(ValueError):
+            op(x, y, out=np.zeros_like(x), block_shape=block_shape)
+
     def test_add(self):
         from elf.parallel import add
         self._test_op(add, np.add)
@@ -113,19 +208,19 @@ class TestOperations(unittest.TestCase):
 
     def test_greater(self):
         from elf.parallel import greater
-        self._test_op(greater, np.greater)
+        self._test_comparison(greater, np.greater)
 
     def test_greater_equal(self):
         from elf.parallel import greater_equal
-        self._test_op(greater_equal, np.greater_equal)
+        self._test_comparison(greater_equal, np.greater_equal)
 
     def test_less(self):
         from elf.parallel import less
-        self._test_op(less, np.less)
+        self._test_comparison(less, np.less)
 
     def test_less_equal(self):
         from elf.parallel import less_equal
-        self._test_op(less_equal, np.less_equal)
+        self._test_comparison(less_equal, np.less_equal)
 
     def test_minimum(self):
         from elf.parallel import minimum
@@ -135,6 +230,119 @@ class TestOperations(unittest.TestCase):
         from elf.parallel import maximum
         self._test_op(maximum, np.maximum)
 
+    def test_masked_byte_order(self):
+        from elf.parallel import add
+        shape = 3 * (32,)
+        block_shape = 3 * (8,)
+        x = np.random.rand(*shape)
+        y = np.random.rand(*shape)
+        mask = np.random.rand(*shape) > .5
+        exp = x.copy()
+        exp[mask] += y[mask]
+
+        # big-endian operands are processed with numpy instead of the compiled kernels
+        res = add(x.astype('>f8'), y.astype('>f8'), block_shape=block_shape, mask=mask)
+        self.assertTrue(np.allclose(res, exp))
+        # and native operands can still use the kernels afterwards
+        res = add(x.copy(), y, block_shape=block_shape, mask=mask)
+        self.assertTrue(np.allclose(res, exp))
+
+    def test_error(self):
+        from elf.parallel import apply_operation
+
+        def _failing_operation(x, y):
+            raise RuntimeError("Operation failed")
+
+        x = np.random.rand(*(3 * (64,)))
+        with self.assertRaises(RuntimeError):
+            apply_operation(x, 1., _failing_operation, block_shape=3 * (16,))
+
+    @unittest.skipUnless(h5py, "Need h5py")
+    def test_hdf5(self):
+        from elf.parallel import add
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        path = os.path.join(self.tmp_folder, 'data.h5')
+
+        shape = 3 * (50,)
+        chunks = 3 * (16,)
+        x = np.random.rand(*shape)
+        y = np.random.rand(*shape)
+        mask = np.random.rand(*shape) > .5
+
+        # test with chunk-aligned blocks (which use direct chunk access if possible)
+        # and with blocks that are not aligned
+        for compression, shuffle in ((None, False), ('gzip', False), ('gzip', True)):
+            for block_shape in (chunks, 3 * (20,)):
+                with h5py.File(path, 'w') as f:
+                    ds_x = f.create_dataset('x', data=x, chunks=chunks, compression=compression, shuffle=shuffle)
+                    ds_out = f.create_dataset('out', shape=shape, dtype=x.dtype, chunks=chunks,
+                                              compression=compression, shuffle=shuffle)
+
+                    add(ds_x, y, out=ds_out, block_shape=block_shape)
+                    self.assertTrue(np.allclose(ds_out[:], x + y))
+
+                    # chunks that were not written yet contain the fill value
+                    ds_empty = f.create_dataset('empty', shape=shape, dtype=x.dtype, chunks=chunks,
+                                                compression=compression, shuffle=shuffle, fillvalue=1.)
+                    add(ds_empty, y, out=ds_out, block_shape=block_shape)
+                    self.assertTrue(np.allclose(ds_out[:], 1. + y))
+
+                    exp = x.copy()
+                    exp[mask] += y[mask]
+                    add(ds_x, y, block_shape=block_shape, mask=mask)
+                    self.assertTrue(np.allclose(ds_x[:], exp))
+
+        # test with rois that end inside of a chunk and at the end of the data,
+        # the data outside of the roi must not be changed
+        for compression, shuffle in ((None, False), ('gzip', False), ('gzip', True)):
+            for roi in (np.s_[:24, 16:40, :], np.s_[16:, 32:, :]):
+                with h5py.File(path, 'w') as f:
+                    ds_out = f.create_dataset('out', data=np.full(shape, 7.), chunks=chunks,
+                                              compression=compression, shuffle=shuffle)
+                    add(x, y, out=ds_out, block_shape=chunks, roi=roi)
+                    exp = np.full(shape, 7.)
+                    exp[roi] = x[roi] + y[roi]
+                    self.assertTrue(np.allclose(ds_out[:], exp))
+
+    def test_expr(self):
+        from elf.parallel import Expr, add, divide, less, minimum, multiply
+        shape = 3 * (64,)
+        # the large blocks are evaluated in several tiles
+        for block_shape in (3 * (16,), (32, 64, 64)):
+            for dtype_x, dtype_y in (('float32', 'float32'), ('int32', 'int32'), ('float64', 'uint8')):
+                x = (100 * np.random.rand(*shape)).astype(dtype_x)
+                y = (100 * np.random.rand(*shape)).astype(dtype_y)
+
+                expr = less(multiply(add(Expr(x), y), 2), 150)
+                self.assertIsInstance(expr, Expr)
+                exp = np.less(np.multiply(np.add(x, y), 2), 150)
+                res = expr.compute(block_shape=block_shape)
+                self.assertEqual(res.dtype, exp.dtype)
+                self.assertTrue(np.array_equal(res, exp))
+
+                exp = np.divide(np.minimum(x, y), 3)
+                res = np.zeros(shape, dtype=exp.dtype)
+                divide(minimum(Expr(x), y), 3, out=res, block_shape=block_shape)
+                self.assertTrue(np.allclose(res, exp))
+
+                # test with mask and broadcasting, like for the other operations
+                # the values outside of the mask are taken from the first operand
+                mask = np.random.rand(*shape) > .5
+                exp = x.copy()
+                exp[mask] = np.add(x, y[:1])[mask]
+                res = np.zeros(shape, dtype=x.dtype)
+                add(Expr(x), y[:1], out=res, mask=mask, block_shape=block_shape)
+                self.assertTrue(np.allclose(res, exp))
+
+                exp = np.add(x, y)
+                exp[mask] = np.multiply(exp, 2)[mask]
+                res = np.zeros(shape, dtype=exp.dtype)
+                multiply(add(Expr(x), y), 2, out=res, mask=mask, block_shape=block_shape)
+                self.assertTrue(np.allclose(res, exp))
+
+        with self.assertRaises(ValueError):
+            add(Expr(x), y, mask=mask, block_shape=block_shape)
+
 
 if __name__ == '__main__':
     unittest.main()
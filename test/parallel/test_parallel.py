@@ -83,6 +83,19 @@ class TestParallel(unittest.TestCase):
         _, ri = rand_index(res, exp)
         self.assertAlmostEqual(ri, 1., places=3)
 
+    def test_get_blocks(self):
+        from elf.parallel.common import get_blocking, get_blocks
+        x = np.zeros((70, 45, 33))
+        block_shape = (16, 8, 5)
+        for roi in (None, np.s_[3:60, 5:40]):
+            blocking = get_blocking(x, block_shape, roi)
+            begins, ends = get_blocks(x, block_shape, roi)
+            self.assertEqual(len(begins), blocking.numberOfBlocks)
+            for block_id, (begin, end) in enumerate(zip(begins, ends)):
+                block = blocking.getBlock(block_id)
+                self.assertEqual(begin.tolist(), list(block.begin))
+                self.assertEqual(end.tolist(), list(block.end))
+
 
 if __name__ == '__main__':
     unittest.main()